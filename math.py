@@ -271,6 +271,23 @@ def get_point_dist_to_line_sq(point, direction, origin):
     closest_point = origin + direction * (point - origin).dot(direction)
     return (closest_point - point).length_squared
 
+def calc_barycentric(p, a, b, c):
+    """
+    Calculates the barycentric coordinates of points in the given triangles.
+    Arguments are numpy arrays with shape (?, 3), returns an array of weights with shape (?, 3).
+    """
+    v0, v1, v2 = b - a, c - a, p - a
+    d00 = np.einsum('ij,ij->i', v0, v0)
+    d01 = np.einsum('ij,ij->i', v0, v1)
+    d11 = np.einsum('ij,ij->i', v1, v1)
+    d20 = np.einsum('ij,ij->i', v2, v0)
+    d21 = np.einsum('ij,ij->i', v2, v1)
+    denom = d00 * d11 - d01 * d01
+    denom[denom == 0.0] = 1.0  # Degenerate triangle, all weight goes to the first vertex
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+    return np.stack((1.0 - v - w, v, w), axis=-1)
+
 def calc_best_fit_line(points):
     """
     Calculates the best fit line that minimizes distance from the line to each point.
@@ -1,9 +1,11 @@
 from itertools import dropwhile, chain
 from math import pi
+from mathutils.bvhtree import BVHTree
 import bmesh
 import bpy
+import numpy as np
 
-from .helpers import edit_mesh_elements, bmesh_vertex_group_bleed
+from .helpers import bmesh_vertex_group_bleed, get_face_region
 from ..helpers import (
     get_context,
     get_modifier,
@@ -11,10 +13,28 @@ from ..helpers import (
     link_properties,
     TempModifier,
 )
+from ..math import calc_barycentric
 from ..operator import SaveContext
+from ..rbf import transform_points
 
 face_map_name = "Graft"
 
+def get_nearest_normals(bvh, points, vert_cos, tri_verts, tri_loops, loop_normals):
+    """
+    Returns the unit normals at the surface points nearest to each point, interpolated from the
+    loop normals of the triangle they lie in. The BVH tree is expected to be built from triangles.
+    """
+
+    nearest = [bvh.find_nearest(point) for point in points]
+    nearest_cos = np.array([co for co, normal, tri_idx, dist in nearest]).reshape((-1, 3))
+    nearest_tri_indices = np.array([tri_idx for co, normal, tri_idx, dist in nearest], dtype=int)
+    tri_cos = vert_cos[tri_verts[nearest_tri_indices]]
+    weights = calc_barycentric(nearest_cos, tri_cos[:, 0], tri_cos[:, 1], tri_cos[:, 2])
+    normals = np.einsum('ij,ijk->ik', weights, loop_normals[tri_loops[nearest_tri_indices]])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0.0] = 1.0
+    return normals / lengths
+
 class GRET_OT_graft(bpy.types.Operator):
     """Connect boundaries of selected objects to the active object"""
 
@@ -77,23 +97,57 @@ class GRET_OT_graft(bpy.types.Operator):
         assert dst_obj not in objs
         save.selection()
 
-        # Get an evaluated version of the destination object
-        # Can't use to_mesh because we will need to enter edit mode on it
-        dg = context.evaluated_depsgraph_get()
         orig_dst_obj = dst_obj
-        eval_obj = orig_dst_obj.evaluated_get(dg)
-        dst_mesh = bpy.data.meshes.new_from_object(eval_obj)
-        dst_obj = bpy.data.objects.new(eval_obj.name, dst_mesh)
-        dst_obj.matrix_world = eval_obj.matrix_world
-        context.scene.collection.objects.link(dst_obj)
-        save.temporary_bids([dst_mesh, dst_obj])
-
+        # Work on a snapshot if the destination is deformed. Also when grafting several objects with
+        # masks, since those are added to the destination and later objects shouldn't see them
+        needs_snapshot = (any(mod.show_viewport for mod in orig_dst_obj.modifiers)
+            or orig_dst_obj.data.shape_keys
+            or (self.create_mask and len(objs) > 1))
+        if needs_snapshot:
+            # Get an evaluated version of the destination object
+            # Can't use to_mesh because it's needed as an object to be the target of modifiers
+            dg = context.evaluated_depsgraph_get()
+            eval_obj = orig_dst_obj.evaluated_get(dg)
+            dst_mesh = bpy.data.meshes.new_from_object(eval_obj)
+            dst_obj = bpy.data.objects.new(eval_obj.name, dst_mesh)
+            dst_obj.matrix_world = eval_obj.matrix_world
+            context.scene.collection.objects.link(dst_obj)
+            save.temporary_bids([dst_mesh, dst_obj])
+        else:
+            # Evaluated mesh would be identical, avoid the copy and use the destination directly
+            dst_mesh = orig_dst_obj.data
+        # Destination geometry doesn't change while grafting, cache what's needed from it once
+        dst_face_centers = np.empty(len(dst_mesh.polygons) * 3)
+        dst_mesh.polygons.foreach_get('center', dst_face_centers)
+        dst_face_centers = dst_face_centers.reshape((-1, 3))
+        dst_vert_cos = np.empty(len(dst_mesh.vertices) * 3)
+        dst_mesh.vertices.foreach_get('co', dst_vert_cos)
+        dst_vert_cos = dst_vert_cos.reshape((-1, 3))
+        dst_mesh.calc_loop_triangles()
+        num_dst_tris = len(dst_mesh.loop_triangles)
+        dst_tri_verts = np.empty(num_dst_tris * 3, dtype=np.int32)
+        dst_mesh.loop_triangles.foreach_get('vertices', dst_tri_verts)
+        dst_tri_verts = dst_tri_verts.reshape((-1, 3))
+        dst_tri_loops = np.empty(num_dst_tris * 3, dtype=np.int32)
+        dst_mesh.loop_triangles.foreach_get('loops', dst_tri_loops)
+        dst_tri_loops = dst_tri_loops.reshape((-1, 3))
+        dst_tri_faces = np.empty(num_dst_tris, dtype=np.int32)
+        dst_mesh.loop_triangles.foreach_get('polygon_index', dst_tri_faces)
+        dst_bvh = BVHTree.FromPolygons(dst_vert_cos.tolist(), dst_tri_verts.tolist())
+        if self.transfer_normals:
+            dst_mesh.calc_normals_split()
+            dst_loop_normals = np.empty(len(dst_mesh.loops) * 3)
+            dst_mesh.loops.foreach_get('normal', dst_loop_normals)
+            dst_loop_normals = dst_loop_normals.reshape((-1, 3))
+
+        world_to_dst = dst_obj.matrix_world.inverted()
+
+        # Objects are grafted one at a time. Other than numpy, the work is bmesh and bpy calls that
+        # hold the GIL and aren't thread safe, so it can't be spread over worker threads
         for obj in objs:
             # Initial setup
-            obj_to_world = obj.matrix_world.copy()
-            world_to_obj = obj.matrix_world.inverted()
-            dst_to_obj = world_to_obj @ dst_obj.matrix_world
-            obj_to_dst = dst_to_obj.inverted()
+            obj_to_dst = np.array(world_to_dst @ obj.matrix_world)
+            dst_to_obj = np.linalg.inv(obj_to_dst)
 
             boundary_vg = get_vgroup(obj)
             save.temporary(obj.vertex_groups, boundary_vg.name)
@@ -102,8 +156,7 @@ class GRET_OT_graft(bpy.types.Operator):
 
             # The source edge loop is currently the mesh boundary. Not doing any validation
             edges1 = [e for e in bm.edges if e.is_boundary]
-            for edge in edges1:
-                boundary_vg.add([edge.verts[0].index, edge.verts[1].index], 1.0, 'REPLACE')
+            boundary_vg.add(list({v.index for e in edges1 for v in e.verts}), 1.0, 'REPLACE')
 
             if not edges1:
                 bm.free()
@@ -127,6 +180,7 @@ class GRET_OT_graft(bpy.types.Operator):
             bool_mod.operation = 'INTERSECT'
             bool_mod.solver = 'FAST'
             bool_mod.object = dst_obj
+            # Modifiers were just added so the depsgraph needs updating for every object
             dg = context.evaluated_depsgraph_get()
             bool_bm = bmesh.new()
             bool_bm.from_object(obj, dg)
@@ -135,17 +189,19 @@ class GRET_OT_graft(bpy.types.Operator):
 
             # Because the result of the boolean operation mostly matches the destination geometry,
             # all that's needed is finding those same faces in the original mesh
+            face_centers = np.array([face.calc_center_median() for face in bool_bm.faces])
+            bool_bm.free()
+            face_centers = transform_points(face_centers.reshape((-1, 3)), obj_to_dst)
             intersecting_face_indices = []
-            for face in bool_bm.faces:
-                p = obj_to_dst @ face.calc_center_median()
-                result, closest_point, normal, face_idx = dst_obj.closest_point_on_mesh(p)
-                if result:
-                    if (dst_mesh.polygons[face_idx].center - p).length_squared <= 0.05:
+            for p in face_centers:
+                closest_point, normal, tri_idx, dist = dst_bvh.find_nearest(p)
+                if tri_idx is not None:
+                    face_idx = int(dst_tri_faces[tri_idx])
+                    if np.sum((dst_face_centers[face_idx] - p) ** 2) <= 0.05:
                         intersecting_face_indices.append(face_idx)
 
             while saved_active_modifiers:
                 saved_active_modifiers.pop().show_viewport = True
-            bool_bm.free()
 
             if not intersecting_face_indices:
                 bm.free()
@@ -153,19 +209,15 @@ class GRET_OT_graft(bpy.types.Operator):
                 return
 
             # The target edge loop is the boundary of the intersection. Recreate it in working bmesh
-            edit_mesh_elements(dst_obj, 'FACE', intersecting_face_indices)
-            for _ in range(self.expand):
-                bpy.ops.mesh.select_more()
-            bpy.ops.object.editmode_toggle()
-            intersecting_vert_indices = [v.index for v in dst_mesh.vertices if v.select]
-            bpy.ops.object.editmode_toggle()
-            bpy.ops.mesh.region_to_loop()
-            bpy.ops.object.editmode_toggle()
-            idx_to_bmvert = {v.index: bm.verts.new(dst_to_obj @ v.co)
-                for v in dst_mesh.vertices if v.select}
+            intersecting_vert_indices, boundary_edges = get_face_region(dst_mesh,
+                intersecting_face_indices, expand=self.expand)
+            boundary_vert_indices = np.unique(boundary_edges)
+            boundary_vert_cos = transform_points(dst_vert_cos[boundary_vert_indices], dst_to_obj)
+            idx_to_bmvert = {idx: bm.verts.new(co)
+                for idx, co in zip(boundary_vert_indices.tolist(), boundary_vert_cos)}
             bm.verts.index_update()
-            edges2 = [bm.edges.new((idx_to_bmvert[e.vertices[0]], idx_to_bmvert[e.vertices[1]]))
-                for e in dst_mesh.edges if e.select]
+            edges2 = [bm.edges.new((idx_to_bmvert[idx0], idx_to_bmvert[idx1]))
+                for idx0, idx1 in boundary_edges.tolist()]
             bm.edges.index_update()
             fm_layer = bm.faces.layers.face_map.verify()
 
@@ -190,34 +242,57 @@ class GRET_OT_graft(bpy.types.Operator):
 
             # Begin transferring data from the destination mesh
             deform_layer = bm.verts.layers.deform.verify()
-            for edge in bm.edges:
-                if edge.is_boundary:
-                    for vert in edge.verts:
-                        vert[deform_layer][boundary_vg.index] = 1.0
+            for vert in {v for e in bm.edges if e.is_boundary for v in e.verts}:
+                vert[deform_layer][boundary_vg.index] = 1.0
             if self.transfer_normals:
                 bmesh_vertex_group_bleed(bm, boundary_vg.index,
                     distance=self.normal_blend_distance,
                     power=self.normal_blend_power)
 
             # Apply the result
+            if self.transfer_normals:
+                vert_weights = np.array([v[deform_layer].get(boundary_vg.index, 0.0)
+                    for v in bm.verts])
             bm.to_mesh(obj.data)
             bm.free()
 
-            ctx = get_context(obj)
             if self.transfer_normals:
-                obj.data.use_auto_smooth = True
-                obj.data.auto_smooth_angle = pi
-                bpy.ops.mesh.customdata_custom_splitnormals_clear(ctx)
-
-                with TempModifier(obj, type='DATA_TRANSFER') as data_mod:
-                    data_mod.object = dst_obj
-                    data_mod.vertex_group = boundary_vg.name
-                    data_mod.use_object_transform = True
-                    data_mod.use_loop_data = True
-                    data_mod.data_types_loops = {'CUSTOM_NORMAL'}
-                    data_mod.loop_mapping = 'POLYINTERP_NEAREST'
+                mesh = obj.data
+                mesh.use_auto_smooth = True
+                mesh.auto_smooth_angle = pi
+                if mesh.has_custom_normals:
+                    # Start from automatic normals, zero vectors reset custom normals to default
+                    mesh.normals_split_custom_set(np.zeros((len(mesh.loops), 3)))
+
+                # Blend towards the normals of the destination surface by boundary weight
+                # Similar to a data transfer modifier, though interpolated per triangle and lerped
+                mesh.calc_normals_split()
+                normals = np.empty(len(mesh.loops) * 3)
+                mesh.loops.foreach_get('normal', normals)
+                normals = normals.reshape((-1, 3))
+                loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+                mesh.loops.foreach_get('vertex_index', loop_verts)
+                vert_cos = np.empty(len(mesh.vertices) * 3)
+                mesh.vertices.foreach_get('co', vert_cos)
+                vert_indices = np.flatnonzero(vert_weights > 0.0)
+                vert_cos = transform_points(vert_cos.reshape((-1, 3))[vert_indices], obj_to_dst)
+                vert_normals = np.zeros((len(mesh.vertices), 3))
+                vert_normals[vert_indices] = get_nearest_normals(dst_bvh, vert_cos,
+                    dst_vert_cos, dst_tri_verts, dst_tri_loops, dst_loop_normals)
+                # Back to object space, normals are transformed by the inverse transpose
+                # Normalize again since a scaled transform doesn't preserve length
+                vert_normals = vert_normals @ obj_to_dst[:3, :3]
+                vert_normal_lengths = np.linalg.norm(vert_normals, axis=1, keepdims=True)
+                vert_normal_lengths[vert_normal_lengths == 0.0] = 1.0
+                vert_normals /= vert_normal_lengths
+                loop_weights = vert_weights[loop_verts, np.newaxis]
+                normals += (vert_normals[loop_verts] - normals) * loop_weights
+                lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+                lengths[lengths == 0.0] = 1.0
+                mesh.normals_split_custom_set(normals / lengths)
 
             if self.transfer_vertex_groups or self.transfer_uv:
+                ctx = get_context(obj)
                 with TempModifier(obj, type='DATA_TRANSFER') as data_mod:
                     data_mod.object = dst_obj
                     data_mod.use_object_transform = True
@@ -234,8 +309,9 @@ class GRET_OT_graft(bpy.types.Operator):
             # If requested, create a mask modifier that will hide the intersection's inner verts
             if self.create_mask:
                 mask_vg = get_vgroup(orig_dst_obj, f"_mask_{obj.name}")
-                intersecting_verts = (dst_mesh.vertices[i] for i in intersecting_vert_indices)
-                mask_vg.add([v.index for v in intersecting_verts if not v.select], 1.0, 'REPLACE')
+                inner_vert_indices = np.setdiff1d(intersecting_vert_indices, boundary_vert_indices,
+                    assume_unique=True)
+                mask_vg.add(inner_vert_indices.tolist(), 1.0, 'REPLACE')
                 mask_mod = get_modifier(orig_dst_obj, type='MASK', name=mask_vg.name)
                 mask_mod.vertex_group = mask_vg.name
                 mask_mod.invert_vertex_group = True
@@ -3,6 +3,7 @@ from math import cos
 from mathutils import Vector
 import bmesh
 import bpy
+import numpy as np
 import re
 
 from .. import prefs
@@ -93,6 +94,46 @@ def edit_face_map_elements(obj, face_map_name):
 
     return num_selected
 
+def get_face_region(mesh, face_indices, expand=0):
+    """
+    Finds a region of faces without entering edit mode. Equivalent to selecting the faces and
+    using bpy.ops.mesh.select_more to expand the region, then bpy.ops.mesh.region_to_loop.
+
+    Returns the indices of the vertices in the region and its boundary edges as an array of
+    vertex index pairs with shape (?, 2).
+    """
+
+    num_loops = len(mesh.loops)
+    loop_verts = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_verts)
+    loop_edges = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get('edge_index', loop_edges)
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    face_order = np.argsort(loop_starts)
+    loop_faces = np.repeat(face_order, loop_totals[face_order])
+
+    face_sel = np.zeros(len(mesh.polygons), dtype=bool)
+    face_sel[face_indices] = True
+    for _ in range(expand):
+        # Faces sharing a vertex with the region are added to it
+        vert_sel = np.zeros(len(mesh.vertices), dtype=bool)
+        vert_sel[loop_verts[face_sel[loop_faces]]] = True
+        face_sel[loop_faces[vert_sel[loop_verts]]] = True
+    loop_sel = face_sel[loop_faces]
+
+    # Boundary edges have some but not all of their faces in the region, or are open edges
+    edge_num_faces = np.bincount(loop_edges, minlength=len(mesh.edges))
+    edge_num_sel = np.bincount(loop_edges[loop_sel], minlength=len(mesh.edges))
+    edge_is_boundary = (edge_num_sel > 0) & ((edge_num_sel < edge_num_faces) | (edge_num_faces == 1))
+    edge_verts = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+    mesh.edges.foreach_get('vertices', edge_verts)
+    boundary_edges = edge_verts.reshape((-1, 2))[edge_is_boundary]
+
+    return np.unique(loop_verts[loop_sel]), boundary_edges
+
 def get_vcolor(obj, name):
     """Ensures that a vertex color layer with the given name exists."""
 
@@ -1,43 +1,52 @@
 from mathutils import Vector
-import bmesh
-import bpy
 import numpy as np
 
+try:
+    import scipy.linalg
+    import scipy.sparse
+    import scipy.spatial
+except ImportError:
+    scipy = None  # Not bundled with Blender
+
 from . import prefs
 from .math import get_dist
 
 # Based on https://github.com/chadmv/cmt/blob/master/scripts/cmt/rig/meshretarget.py
 # Which in turn references http://mathlab.github.io/PyGeM/_modules/pygem/radial.html#RBF
 
+# Kernels operate in place on the distance matrix to avoid allocating temporaries of the same size
+
 def linear(matrix, radius):
     return matrix
 
 def gaussian(matrix, radius):
-    result = np.exp(-(matrix * matrix) / (radius * radius))
-    return result
+    matrix *= matrix
+    matrix *= -1.0 / (radius * radius)
+    return np.exp(matrix, out=matrix)
 
 def thin_plate(matrix, radius):
-    result = matrix / radius
-    result *= matrix
-    np.warnings.filterwarnings("ignore")
-    result = np.where(result > 0, np.log(result), result)
-    np.warnings.filterwarnings("always")
-    return result
+    matrix *= matrix
+    matrix /= radius
+    return np.log(matrix, out=matrix, where=matrix > 0)
 
 def multi_quadratic_biharmonic(matrix, radius):
-    result = np.sqrt((matrix * matrix) + (radius * radius))
-    return result
+    matrix *= matrix
+    matrix += radius * radius
+    return np.sqrt(matrix, out=matrix)
 
 def inv_multi_quadratic_biharmonic(matrix, radius):
-    result = 1.0 / (np.sqrt((matrix * matrix) + (radius * radius)))
-    return result
+    matrix = multi_quadratic_biharmonic(matrix, radius)
+    return np.reciprocal(matrix, out=matrix)
 
 def beckert_wendland_c2_basis(matrix, radius):
-    arg = matrix / radius
-    first = np.zeros(matrix.shape)
-    first = np.where(1 - arg > 0, np.power(1 - arg, 4), first)
-    second = (4 * arg) + 1
-    result = first * second
+    matrix /= radius
+    np.minimum(matrix, 1.0, out=matrix)
+    result = 1.0 - matrix
+    result *= result
+    result *= result
+    matrix *= 4.0
+    matrix += 1.0
+    result *= matrix
     return result
 
 rbf_kernels = {
@@ -49,20 +58,32 @@ rbf_kernels = {
     'C2': (beckert_wendland_c2_basis, 1.0),
 }
 
+# Distance relative to radius past which kernels are zero or negligible. Others have global support
+rbf_kernel_cutoffs = {
+    gaussian: 6.0,  # exp(-36) is below double precision relative to the peak
+    beckert_wendland_c2_basis: 1.0,
+}
+
 def get_weight_matrix(src_pts, dst_pts, rbf, radius):
     """Get the weight matrix x in Ax=B."""
 
     assert src_pts.shape == dst_pts.shape
     num_pts, dim = src_pts.shape
-    identity = np.ones((num_pts, 1))
     dist = get_distance_matrix(src_pts, src_pts, rbf, radius)
+    if scipy:
+        try:
+            return solve_weight_matrix_cholesky(dist, src_pts, dst_pts)
+        except np.linalg.LinAlgError:
+            pass
     # Solve x for Ax=B
-    H = np.bmat([
-        [dist, identity, src_pts],
-        [identity.T, np.zeros((1, 1)), np.zeros((1, dim))],
-        [src_pts.T, np.zeros((dim, 1)), np.zeros((dim, dim))],
-    ])
-    rhs = np.bmat([[dst_pts], [np.zeros((1, dim))], [np.zeros((dim, dim))]])
+    H = np.zeros((num_pts + 1 + dim, num_pts + 1 + dim))
+    H[:num_pts, :num_pts] = dist
+    H[:num_pts, num_pts] = 1.0
+    H[:num_pts, num_pts+1:] = src_pts
+    H[num_pts, :num_pts] = 1.0
+    H[num_pts+1:, :num_pts] = src_pts.T
+    rhs = np.zeros((num_pts + 1 + dim, dim))
+    rhs[:num_pts] = dst_pts
     weights = None
     try:
         weights = np.linalg.solve(H, rhs)
@@ -75,60 +96,140 @@ def get_weight_matrix(src_pts, dst_pts, rbf, radius):
             weights = Hpinv.dot(rhs)
     return weights
 
+def solve_weight_matrix_cholesky(dist, src_pts, dst_pts):
+    """Get the weight matrix x in Ax=B, where the distance matrix is positive definite.
+    Raises LinAlgError if it isn't, which is the case for some of the kernels."""
+
+    # Factor only the distance matrix, the affine terms are solved through the Schur complement
+    num_pts, dim = src_pts.shape
+    P = np.empty((num_pts, 1 + dim))
+    P[:, 0] = 1.0
+    P[:, 1:] = src_pts
+    factor = scipy.linalg.cho_factor(dist, lower=True, check_finite=False)
+    dist_inv_P = scipy.linalg.cho_solve(factor, P, check_finite=False)
+    dist_inv_B = scipy.linalg.cho_solve(factor, dst_pts, check_finite=False)
+    affine = np.linalg.solve(P.T @ dist_inv_P, P.T @ dist_inv_B)
+    return np.vstack((dist_inv_B - dist_inv_P @ affine, affine))
+
 def get_distance_matrix(v1, v2, rbf, radius):
-    # numpy alternative to scipy.spatial.distance.cdist(v1, v2, 'euclidean')
-    matrix = v1[:, np.newaxis, :] - v2[np.newaxis, :, :]
-    matrix = np.linalg.norm(matrix, axis=-1)
+    # Expand |a-b|^2 into |a|^2 - 2a.b + |b|^2 so the bulk of the work is a single matrix product
+    # Center the points first to keep the expansion from losing precision far from the origin
+    center = v2.mean(axis=0)
+    v1 = v1 - center
+    v2 = v2 - center
+    matrix = v1 @ v2.T
+    matrix *= -2.0
+    matrix += np.einsum('ij,ij->i', v1, v1)[:, np.newaxis]
+    matrix += np.einsum('ij,ij->i', v2, v2)[np.newaxis, :]
+    # Coincident points should be exactly zero apart, some kernels are discontinuous at zero
+    matrix[matrix < 1e-10] = 0.0
+    np.sqrt(matrix, out=matrix)
     return rbf(matrix, radius)
 
-def transform_points(pts, matrix):
-    identity = np.ones((len(pts), 1))
-    new_pts = np.c_[pts, identity]
-    new_pts = np.einsum('ij,aj->ai', matrix, new_pts)
-    new_pts = new_pts[:, :-1]
+def get_sparse_distance_matrix(v1, v2_tree, rbf, radius, cutoff):
+    # Only distances within the cutoff are evaluated, the rest of the matrix is implicitly zero
+    pairs = scipy.spatial.cKDTree(v1).sparse_distance_matrix(v2_tree, cutoff * radius,
+        output_type='ndarray')
+    return scipy.sparse.csr_matrix((rbf(pairs['v'], radius), (pairs['i'], pairs['j'])),
+        shape=(v1.shape[0], v2_tree.n))
+
+def get_sparse_tree(src_pts, rbf, radius, max_density=0.1):
+    """Return a KD-tree of the source points if the kernel is worth evaluating sparsely, otherwise
+    None. Meant to be built once and passed to every apply_weight_matrix call."""
+
+    cutoff = rbf_kernel_cutoffs.get(rbf)
+    if not scipy or cutoff is None:
+        return None
+    src_tree = scipy.spatial.cKDTree(src_pts)
+    # Sparse evaluation is only faster when the cutoff covers a small share of the source points
+    # Estimate the neighbor count from a sample, querying the source points themselves
+    sample_pts = src_pts[::max(1, len(src_pts) // 256)]
+    num_neighbors = src_tree.query_ball_point(sample_pts, cutoff * radius, return_length=True)
+    if np.mean(num_neighbors) > len(src_pts) * max_density:
+        return None
+    return src_tree
+
+def apply_weight_matrix(pts, src_pts, weights, rbf, radius, src_tree=None, block_size=4096):
+    """Return the points resulting from applying the weight matrix x to the given points.
+    If a tree from get_sparse_tree is given, the kernel is evaluated sparsely."""
+
+    # Points are processed in blocks so the distance matrix never has to exist in full
+    num_pts, dim = pts.shape
+    num_src_pts = src_pts.shape[0]
+    new_pts = np.empty((num_pts, weights.shape[1]))
+
+    if src_tree is not None:
+        # Kernel has compact support, most of the distance matrix would be zeroes
+        cutoff = rbf_kernel_cutoffs[rbf]
+        for start in range(0, num_pts, block_size):
+            block_pts = pts[start:start+block_size]
+            block_new_pts = new_pts[start:start+len(block_pts)]
+            np.matmul(block_pts, weights[num_src_pts+1:], out=block_new_pts)
+            block_new_pts += weights[num_src_pts]
+            dist = get_sparse_distance_matrix(block_pts, src_tree, rbf, radius, cutoff)
+            block_new_pts += dist @ weights[:num_src_pts]
+        return new_pts
+
+    h = np.empty((min(num_pts, block_size), num_src_pts + 1 + dim))
+    h[:, num_src_pts] = 1.0
+    for start in range(0, num_pts, block_size):
+        block_pts = pts[start:start+block_size]
+        block_h = h[:len(block_pts)]
+        block_h[:, :num_src_pts] = get_distance_matrix(block_pts, src_pts, rbf, radius)
+        block_h[:, num_src_pts+1:] = block_pts
+        np.matmul(block_h, weights, out=new_pts[start:start+len(block_pts)])
     return new_pts
 
+def transform_points(pts, matrix):
+    matrix = np.asarray(matrix)
+    return pts @ matrix[:3, :3].T + matrix[:3, 3]
+
+def get_vertex_group_weights(obj, vertex_group_name):
+    """
+    Return the weights of a vertex group as a numpy array with one value per vertex.
+    Weights can't be read with foreach_get, this walks every vertex and its groups in Python.
+    """
+
+    vertex_group_index = obj.vertex_groups[vertex_group_name].index
+    weights = np.zeros(len(obj.data.vertices))
+    for vert in obj.data.vertices:
+        for group in vert.groups:
+            if group.group == vertex_group_index:
+                weights[vert.index] = group.weight
+                break
+    return weights
+
 def get_mesh_points(obj, matrix=None, shape_key=None, mask=None, stride=1, x_mirror=None):
     """Return vertex coordinates of a mesh as a numpy array with shape (?, 3)."""
-    # Moving the mesh seems to be faster. See https://blender.stackexchange.com/questions/139511
 
     assert obj.type == 'MESH'
     mesh = obj.data
 
-    if matrix is not None:
-        mesh = mesh.copy()
-        mesh.transform(matrix)
-
     shape_key = mesh.shape_keys.key_blocks[shape_key] if shape_key else None
-    points = np.zeros(len(mesh.vertices)*3, dtype=np.float)
+    vertices = mesh.vertices if shape_key is None else shape_key.data
+    points = np.empty(len(vertices)*3, dtype=np.float32)
+    vertices.foreach_get('co', points)
+    points = points.reshape((-1, 3)).astype(np.float64)
     if shape_key and shape_key.vertex_group:
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
-        bm.verts.layers.shape.verify()
-        base_shape_layer = bm.verts.layers.shape[shape_key.relative_key.name]
-        shape_layer = bm.verts.layers.shape[shape_key.name]
-        deform_layer = bm.verts.layers.deform.verify()
-        vertex_group_index = obj.vertex_groups[shape_key.vertex_group].index
-        for vert_idx, vert in enumerate(bm.verts):
-            w = vert[deform_layer].get(vertex_group_index, 0.0)
-            points[vert_idx*3:vert_idx*3+3] = vert[base_shape_layer].lerp(vert[shape_layer], w)
-        bm.free()
-    else:
-        vertices = mesh.vertices if shape_key is None else shape_key.data
-        vertices.foreach_get('co', points)
+        # Blend from the relative key using the shape key's vertex group as the factor
+        # Only this case pays for reading vertex weights one vertex at a time
+        base_points = np.empty(len(vertices)*3, dtype=np.float32)
+        shape_key.relative_key.data.foreach_get('co', base_points)
+        base_points = base_points.reshape((-1, 3))
+        weights = get_vertex_group_weights(obj, shape_key.vertex_group)
+        points = base_points + (points - base_points) * weights[:, np.newaxis]
 
-    points = points.reshape((-1, 3))
     if mask is not None:
         points = points[mask]
     points = points[::stride]
+    if matrix is not None:
+        points = transform_points(points, matrix)
 
     if isinstance(x_mirror, list):
         if not x_mirror:
-            x_mirror[:] = np.ravel(np.where(points[:,0] > 1e-4))
-        points = np.append(points, points[x_mirror] * [-1, 1, 1], axis=0)
-
-    if matrix is not None:
-        bpy.data.meshes.remove(mesh)
+            x_mirror[:] = np.flatnonzero(points[:,0] > 1e-4)
+        if x_mirror:
+            points = np.append(points, points[x_mirror] * [-1, 1, 1], axis=0)
 
     return points
 
@@ -138,6 +239,7 @@ def set_mesh_points(obj, new_pts, matrix=None, shape_key_name=None):
 
     if matrix is not None:
         new_pts = transform_points(new_pts, matrix)
+    new_pts = new_pts.astype(np.float32).ravel()
 
     if shape_key_name is not None:
         # Result to new shape key
@@ -146,20 +248,28 @@ def set_mesh_points(obj, new_pts, matrix=None, shape_key_name=None):
         shape_key = obj.data.shape_keys.key_blocks.get(shape_key_name)
         if not shape_key or not prefs.retarget__overwrite_shape_key:
             shape_key = obj.shape_key_add(name=shape_key_name)
-        shape_key.data.foreach_set('co', new_pts.ravel())
+        shape_key.data.foreach_set('co', new_pts)
         shape_key.value = 1.0
     elif mesh.shape_keys and mesh.shape_keys.key_blocks:
-        # There are shape keys, so replace the basis
-        # Using bmesh propagates the change, where just setting the coordinates won't
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
-        for vert, new_pt in zip(bm.verts, new_pts):
-            vert.co[:] = new_pt
-        bm.to_mesh(mesh)
-        bm.free()
+        # There are shape keys, so replace the basis. Just setting the coordinates won't propagate
+        # the change, offset the shape keys relative to the basis like bmesh.to_mesh would
+        # Absolute shape keys are left alone
+        basis = mesh.shape_keys.reference_key
+        offset = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+        basis.data.foreach_get('co', offset)
+        np.subtract(new_pts, offset, out=offset)
+        co = np.empty_like(offset)
+        if mesh.shape_keys.use_relative:
+            for shape_key in mesh.shape_keys.key_blocks:
+                if shape_key != basis and shape_key.relative_key == basis:
+                    shape_key.data.foreach_get('co', co)
+                    co += offset
+                    shape_key.data.foreach_set('co', co)
+        basis.data.foreach_set('co', new_pts)
+        mesh.vertices.foreach_set('co', new_pts)
     else:
         # Set new coordinates directly
-        mesh.vertices.foreach_set('co', new_pts.ravel())
+        mesh.vertices.foreach_set('co', new_pts)
 
 def get_armature_points(obj, matrix=None):
     """Return head and tail coordinates of armature bones as a numpy array with shape (?, 3)."""
@@ -114,8 +114,11 @@ Doubles the input vertex count, don't enable if not necessary""",
             vertex_cap = prefs.retarget__max_vertices_high
         else:
             vertex_cap = prefs.retarget__max_vertices_low
-        mask = [v.select for v in src_obj.data.vertices] if self.only_selection else None
-        num_masked = sum(mask) if mask else num_vertices
+        mask = None
+        if self.only_selection:
+            mask = np.empty(num_vertices, dtype=bool)
+            src_obj.data.vertices.foreach_get('select', mask)
+        num_masked = np.count_nonzero(mask) if mask is not None else num_vertices
         stride = ceil(num_masked / vertex_cap)
         if num_masked == 0:
             self.report({'ERROR'}, "Source mesh has no vertices selected.")
@@ -123,19 +126,20 @@ Doubles the input vertex count, don't enable if not necessary""",
         logd(f"num_verts={num_masked}/{num_vertices} stride={stride} total={num_masked//stride}")
 
         rbf_kernel, scale = rbf_kernels.get(self.function, (linear, 1.0))
+        rbf_radius = self.radius * scale
         x_mirror = [] if self.use_mirror_x else None
         src_pts = get_mesh_points(src_obj,
             mask=mask, stride=stride, x_mirror=x_mirror)
-        if not x_mirror:
-            x_mirror = None  # No vertices to mirror, prevent it from attempting to mirror again
+        # Reuse the source mirror indices. If there were none, don't attempt to mirror again
         dst_pts = get_mesh_points(dst_obj,
-            shape_key=dst_shape_key_name, mask=mask, stride=stride, x_mirror=x_mirror)
+            shape_key=dst_shape_key_name, mask=mask, stride=stride, x_mirror=x_mirror or None)
         if self.invert:
             src_pts, dst_pts = dst_pts, src_pts
-        weights = get_weight_matrix(src_pts, dst_pts, rbf_kernel, self.radius * scale)
+        weights = get_weight_matrix(src_pts, dst_pts, rbf_kernel, rbf_radius)
         if weights is None:
             self.report({'ERROR'}, "Failed to retarget. Try a different function or radius.")
             return {'CANCELLED'}
+        src_tree = get_sparse_tree(src_pts, rbf_kernel, rbf_radius)
 
         for obj in context.selected_objects:
             if obj.type != 'ARMATURE':
@@ -159,10 +163,8 @@ Doubles the input vertex count, don't enable if not necessary""",
             if num_pts == 0:
                 continue
 
-            dist = get_distance_matrix(pts, src_pts, rbf_kernel, self.radius * scale)
-            identity = np.ones((num_pts, 1))
-            h = np.bmat([[dist, identity, pts]])
-            new_pts = np.asarray(np.dot(h, weights))
+            new_pts = apply_weight_matrix(pts, src_pts, weights, rbf_kernel, rbf_radius,
+                src_tree=src_tree)
 
             set_armature_points(obj, new_pts, matrix=dst_to_obj, only_selected=is_editing,
                 lock_length=self.lock_length, lock_direction=self.lock_direction)